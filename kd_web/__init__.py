@@ -1,10 +1,9 @@
 """Simple streamlit app for interactive parsing and drawing."""
 
-from importlib.metadata import version
 from urllib.error import HTTPError
 from typing import Any
 
-import yaml
+from yaml import YAMLError
 from code_editor import code_editor  # type: ignore
 
 import streamlit as st
@@ -16,22 +15,25 @@ from .utils import (
     decode_permalink_param,
     get_about,
     get_default_config,
+    get_config_digest,
     get_example_yamls,
     get_permalink,
+    get_repo_ref,
     parse_zmk_url_to_yaml,
+    refresh_zmk_url,
     svg_to_png,
 )
 from .kd_interface import (
     read_keymap_yaml,
-    draw,
+    draw_keymap,
     parse_config,
     parse_qmk_to_yaml,
-    parse_zmk_to_yaml,
+    parse_zmk_upload_to_yaml,
 )
-from .constants import REPO_REF
 
 
-EDITOR_BUTTONS = [
+EDITOR_EVENT_TYPES = frozenset(("submit", "blur"))  # editor responses that update the keymap
+EDITOR_BUTTONS = (  # JSON-encoded by the component on each run, so plain containers only
     {
         "name": "Settings",
         "feather": "Settings",
@@ -57,7 +59,7 @@ EDITOR_BUTTONS = [
         "commands": ["submit"],
         "style": {"bottom": "0.44rem", "right": "0.4rem", "background-color": "#80808050"},
     },
-]
+)
 
 
 @st.dialog("About this tool", width="large")
@@ -87,35 +89,80 @@ def setup_page():
         "Check out the documentation and Python CLI tool in the "
         "[GitHub repo](https://github.com/caksoylar/keymap-drawer)!"
     )
+    repo_ref = get_repo_ref()
     c2.caption(
-        f"`keymap-drawer` version: [{REPO_REF}](https://github.com/caksoylar/keymap-drawer/releases/tag/{REPO_REF})"
+        f"`keymap-drawer` version: [{repo_ref}](https://github.com/caksoylar/keymap-drawer/releases/tag/{repo_ref})"
     )
     if c2.button("What is this tool?"):
         display_about()
 
     examples = get_example_yamls()
+    example_keys = list(examples)
     if "kd_config" not in state:
         state.kd_config = get_default_config()
     if "kd_config_obj" not in state:
-        state.kd_config_obj, _ = parse_config(get_default_config())
+        state.kd_config_obj, state.kd_config_log = parse_config(get_default_config())
+        state.kd_config_hash = get_config_digest(get_default_config())
     if "keymap_yaml" not in state:
-        state.keymap_yaml = examples[list(examples)[0]]
+        state.keymap_yaml = examples[example_keys[0]]
     if "code_id" not in state:
         state.code_id = ""
 
-    if state.get("user_query", True):
+    # only consume query params on initial load, since later reruns (e.g. from fragments) should keep user changes
+    initial_query = not state.get("initial_query_consumed", False)
+    if initial_query:
         if query_yaml := st.query_params.get("keymap_yaml"):
             state.keymap_yaml = decode_permalink_param(query_yaml)
             st.query_params.clear()
-        state.example_yaml = st.query_params.get("example_yaml", list(examples)[0])
-        state.qmk_cols = int(st.query_params.get("num_cols", "0"))
-        state.zmk_cols = int(st.query_params.get("num_cols", "0"))
+        state.example_yaml = st.query_params.get("example_yaml", example_keys[0])
+        state.qmk_cols = state.zmk_cols = int(st.query_params.get("num_cols", "0"))
         state.zmk_url = st.query_params.get("zmk_url", "")
+        state.initial_query_consumed = True
+
+    return examples, example_keys, initial_query
 
-    return examples
+
+def zmk_url_form(error_placeholder, num_cols: int, initial_query: bool):
+    """Show the URL input within the ZMK parsing form, parsing the keymap from the given GitHub URL on submit."""
+    st.text_input(
+        label="or, input GitHub URL to keymap",
+        placeholder="https://github.com/caksoylar/zmk-config/blob/main/config/hypergolic.keymap",
+        key="zmk_url",
+    )
+    refresh_url = st.checkbox(
+        "Refresh repo contents", help="Fetch the latest state of the repo instead of a recently parsed one"
+    )
+    zmk_url_submitted = st.form_submit_button(label="Parse from URL!", use_container_width=True)
+    if zmk_url_submitted or initial_query and "zmk_url" in st.query_params:
+        if zmk_url_submitted:
+            st.query_params.from_dict({"zmk_url": state.zmk_url})
+        if not state.zmk_url:
+            st.error(icon="❗", body="Please enter a URL")
+        else:
+            try:
+                zmk_url_args = (
+                    state.zmk_url,
+                    state.kd_config_obj.parse_config,
+                    num_cols,
+                    st.query_params.get("layout", ""),
+                )
+                if zmk_url_submitted and refresh_url:
+                    refresh_zmk_url(*zmk_url_args)
+                state.keymap_yaml, log_out = parse_zmk_url_to_yaml(*zmk_url_args)
+                if log_out:
+                    st.warning(log_out)
+            except HTTPError as err:
+                handle_exception(
+                    error_placeholder,
+                    "Could not get repo contents, make sure you use a branch name"
+                    " or commit SHA and not a tag in the URL",
+                    err,
+                )
+            except Exception as err:
+                handle_exception(error_placeholder, "Error while parsing ZMK keymap from URL", err)
 
 
-def examples_parse_row(examples):
+def examples_parse_row(examples, example_keys, initial_query: bool):
     """Show column with examples and parsing boxes, in order to set up initial keymap."""
     st.subheader(
         "Quick start",
@@ -127,12 +174,11 @@ def examples_parse_row(examples):
     with col_ex:
         with st.popover("Example keymaps", use_container_width=True):
             with st.form("example_form", border=False):
-                st.selectbox(label="Load example", options=list(examples), index=0, key="example_yaml")
+                st.selectbox(label="Load example", options=example_keys, index=0, key="example_yaml")
                 example_submitted = st.form_submit_button(label="Show!", use_container_width=True)
-                if example_submitted or state.get("user_query", True) and "example_yaml" in st.query_params:
+                if example_submitted or initial_query and "example_yaml" in st.query_params:
                     if example_submitted:
-                        st.query_params.clear()
-                        st.query_params.example_yaml = state.example_yaml
+                        st.query_params.from_dict({"example_yaml": state.example_yaml})
                     state.keymap_yaml = examples[state.example_yaml]
     with col_qmk:
         with st.popover("Parse from QMK keymap", use_container_width=True):
@@ -167,7 +213,7 @@ def examples_parse_row(examples):
                         st.error(icon="❗", body="Please upload a keymap file")
                     else:
                         try:
-                            state.keymap_yaml, log_out = parse_zmk_to_yaml(
+                            state.keymap_yaml, log_out = parse_zmk_upload_to_yaml(
                                 zmk_file,
                                 state.kd_config_obj.parse_config,
                                 num_cols,
@@ -178,43 +224,42 @@ def examples_parse_row(examples):
                         except Exception as err:
                             handle_exception(error_placeholder, "Error while parsing ZMK keymap", err)
 
-                st.text_input(
-                    label="or, input GitHub URL to keymap",
-                    placeholder="https://github.com/caksoylar/zmk-config/blob/main/config/hypergolic.keymap",
-                    key="zmk_url",
-                )
-                zmk_url_submitted = st.form_submit_button(label="Parse from URL!", use_container_width=True)
-                if zmk_url_submitted or state.get("user_query", True) and "zmk_url" in st.query_params:
-                    if zmk_url_submitted:
-                        st.query_params.clear()
-                        st.query_params.zmk_url = state.zmk_url
-                    if not state.zmk_url:
-                        st.error(icon="❗", body="Please enter a URL")
-                    else:
-                        try:
-                            state.keymap_yaml, log_out = parse_zmk_url_to_yaml(
-                                state.zmk_url,
-                                state.kd_config_obj.parse_config,
-                                num_cols,
-                                st.query_params.get("layout", ""),
-                            )
-                            if log_out:
-                                st.warning(log_out)
-                        except HTTPError as err:
-                            handle_exception(
-                                error_placeholder,
-                                "Could not get repo contents, make sure you use a branch name"
-                                " or commit SHA and not a tag in the URL",
-                                err,
-                            )
-                        except Exception as err:
-                            handle_exception(error_placeholder, "Error while parsing ZMK keymap from URL", err)
+                zmk_url_form(error_placeholder, num_cols, initial_query)
 
                 st.caption("Please check and if necessary correct the `layout` field after parsing")
 
 
-def keymap_draw_row(need_rerun: bool):
-    """Show the main row with keymap YAML and visualization columns."""
+def draw_session_keymap(keymap_data: dict, draw_opts: dict[str, Any]) -> tuple[str, str]:
+    """Draw the keymap in session state with the given draw options, applying the layout override if uploaded."""
+    layout_override = None
+    if override_file := state.get("qmk_layout_file"):
+        layout_override = {
+            "qmk_info_json" if override_file.name.endswith(".json") else "dts_layout": override_file.getvalue()
+        }
+
+    assert (
+        "layout" in keymap_data or layout_override is not None
+    ), 'Physical layout needs to be specified via the "layout" field in keymap YAML, or via "Layout override"'
+
+    # reuse the last drawing of this session if its inputs didn't change, skipping the draw cache lookup
+    draw_inputs = (state.keymap_yaml, state.kd_config_hash, layout_override, draw_opts)
+    last_inputs, last_output = state.get("last_draw", (None, None))
+    if draw_inputs == last_inputs:
+        svg, log = last_output
+    else:
+        svg, log = draw_keymap(
+            state.keymap_yaml, state.kd_config_obj, state.kd_config_hash, layout_override, **draw_opts
+        )
+        state.last_draw = draw_inputs, (svg, log)
+    return svg, log
+
+
+@st.fragment
+def keymap_draw_row():
+    """
+    Show the main row with keymap YAML and visualization columns. This is a fragment so that interacting with draw
+    filters and export options only reruns this row.
+    """
     keymap_col, draw_col = st.columns(2, gap="medium")
     with keymap_col:
         c1, c2 = st.columns([0.75, 0.25], vertical_alignment="bottom")
@@ -228,7 +273,7 @@ def keymap_draw_row(need_rerun: bool):
         )
         c2.link_button(
             label="Keymap Spec :material/open_in_new:",
-            url=f"https://github.com/caksoylar/keymap-drawer/blob/{REPO_REF}/KEYMAP_SPEC.md",
+            url=f"https://github.com/caksoylar/keymap-drawer/blob/{get_repo_ref()}/KEYMAP_SPEC.md",
             use_container_width=True,
         )
         response_dict = code_editor(
@@ -241,10 +286,10 @@ def keymap_draw_row(need_rerun: bool):
             options={"wrap": True, "tabSize": 2},
             response_mode=["default", "blur"],
         )
-        if response_dict["type"] in ("submit", "blur") and response_dict["id"] != state.code_id:
+        if response_dict["type"] in EDITOR_EVENT_TYPES and response_dict["id"] != state.code_id:
             state.keymap_yaml = response_dict["text"]
             state.code_id = response_dict["id"]
-            need_rerun = True
+            st.rerun(scope="app")  # explicitly refresh keymap editor
 
         c1, c2 = st.columns(2)
         c1.download_button(label="Download keymap :material/download:", data=state.keymap_yaml, file_name="my_keymap.yaml", use_container_width=True)
@@ -279,9 +324,11 @@ def keymap_draw_row(need_rerun: bool):
                         key="qmk_layout_file",
                     )
 
-            cfg = state.kd_config_obj
-            draw_cfg = cfg.draw_config
-            keymap_data = read_keymap_yaml(state.keymap_yaml)
+            # keep the parsed keymap for this session, since cache hits unpickle a fresh copy on every rerun
+            parsed_yaml, keymap_data = state.get("parsed_keymap", (None, None))
+            if parsed_yaml != state.keymap_yaml:
+                keymap_data = read_keymap_yaml(state.keymap_yaml)
+                state.parsed_keymap = state.keymap_yaml, keymap_data
             layer_names = list(keymap_data["layers"])
 
             draw_opts: dict[str, Any] = {}
@@ -304,17 +351,7 @@ def keymap_draw_row(need_rerun: bool):
                     except ValueError as err:
                         handle_exception(st, "Values must be space-separated integers", err)
 
-            layout_override = None
-            if override_file := state.get("qmk_layout_file"):
-                layout_override = {
-                    "qmk_info_json" if override_file.name.endswith(".json") else "dts_layout": state.qmk_layout_file
-                }
-
-            assert (
-                "layout" in keymap_data or layout_override is not None
-            ), 'Physical layout needs to be specified via the "layout" field in keymap YAML, or via "Layout override"'
-
-            svg, log = draw(keymap_data, cfg, layout_override, **draw_opts)
+            svg, log = draw_session_keymap(keymap_data, draw_opts)
 
             if log:
                 draw_container.warning(log)
@@ -326,14 +363,10 @@ def keymap_draw_row(need_rerun: bool):
                     st.subheader("SVG", anchor=False)
                     bg_override = st.checkbox("Override background", value=False)
                     bg_color = st.color_picker("SVG background color", disabled=not bg_override, value="#FFF")
-                    if bg_override:
-                        draw_cfg = draw_cfg.copy(
-                            update={
-                                "svg_extra_style": draw_cfg.svg_extra_style
-                                + f"\nsvg.keymap {{ background-color: {bg_color}; }}"
-                            }
+                    if bg_override:  # append to the last (main) style block of the drawn SVG rather than redrawing
+                        export_svg = f"\nsvg.keymap {{ background-color: {bg_color}; }}</style>".join(
+                            svg.rsplit("</style>", 1)
                         )
-                        export_svg = draw(keymap_data, cfg, layout_override, **draw_opts)
                     else:
                         export_svg = svg
                     st.download_button(label="Download", data=export_svg, file_name="my_keymap.svg")
@@ -345,146 +378,149 @@ def keymap_draw_row(need_rerun: bool):
                         "uses a fixed text font and does not support auto dark mode"
                     )
                     bg_color = st.color_picker("PNG background color", value="#FFF")
-                    st.download_button(label="Export", data=svg_to_png(svg, bg_color), file_name="my_keymap.png")
+                    if st.button("Generate PNG"):  # rasterizing is expensive, only do it on request
+                        state.png_export = (svg, bg_color), svg_to_png(svg, bg_color)
+                    png_inputs, png = state.get("png_export", (None, None))
+                    if png_inputs == (svg, bg_color):
+                        st.download_button(label="Export", data=png, file_name="my_keymap.png")
 
-        except yaml.YAMLError as err:
+        except YAMLError as err:
             handle_exception(draw_container, "Could not parse keymap YAML, please check for syntax errors", err)
         except Exception as err:
             handle_exception(draw_container, "Error while drawing SVG from keymap YAML", err)
-    return need_rerun
 
 
-def configuration_row(need_rerun: bool):
+@st.fragment
+def common_config_form():
+    """Show form for common configuration options, as a fragment so its widgets don't rerun the whole app."""
+    st.subheader("Common configuration options", anchor=False)
+    cfg = state.kd_config_obj  # parsed once per config change, see setup_page, form submit and configuration_row
+    draw_cfg = cfg.draw_config
+    draw_fields = type(draw_cfg).model_fields  # fields vary by keymap-drawer version
+    cfgs: dict[str, Any] = {}
+    with st.form("common_config"):
+        c1, c2 = st.columns(2)
+        with c1:
+            cfgs["key_w"] = st.number_input(
+                "`key_w`",
+                help="Key width, only used for ortho layouts (not QMK)",
+                min_value=1,
+                max_value=999,
+                step=1,
+                value=int(draw_cfg.key_w),
+            )
+        with c2:
+            cfgs["key_h"] = st.number_input(
+                "`key_h`",
+                help="Key height, used for width as well for QMK layouts",
+                min_value=1,
+                max_value=999,
+                step=1,
+                value=int(draw_cfg.key_h),
+            )
+        c1, c2 = st.columns(2)
+        with c1:
+            cfgs["combo_w"] = st.number_input(
+                "`combo_w`",
+                help="Combo box width",
+                min_value=1,
+                max_value=999,
+                step=1,
+                value=int(draw_cfg.combo_w),
+            )
+        with c2:
+            cfgs["combo_h"] = st.number_input(
+                "`combo_h`",
+                help="Combo box height",
+                min_value=1,
+                max_value=999,
+                step=1,
+                value=int(draw_cfg.combo_h),
+            )
+        cfgs["n_columns"] = st.number_input(
+            "`n_columns`",
+            help="Number of layer columns in the output drawing",
+            min_value=1,
+            max_value=99,
+            value=draw_cfg.n_columns,
+        )
+        c1, c2 = st.columns(2, vertical_alignment="bottom")
+        cfgs["draw_key_sides"] = c1.toggle(
+            "`draw_key_sides`", help="Draw key sides, like keycaps", value=draw_cfg.draw_key_sides
+        )
+        if "dark_mode" in draw_fields:
+            dark_mode_options = {"Auto": "auto", "Off": False, "On": True}
+            cfgs["dark_mode"] = dark_mode_options[
+                c2.radio(
+                    "`dark_mode`",
+                    options=list(dark_mode_options),
+                    help='Turn on dark mode, "auto" adapts it to the web page or OS light/dark setting',
+                    horizontal=True,
+                    index=list(dark_mode_options.values()).index(draw_cfg.dark_mode),
+                )  # type: ignore
+            ]
+        c1, c2 = st.columns(2, vertical_alignment="bottom")
+        with c1:
+            cfgs["separate_combo_diagrams"] = st.toggle(
+                "`separate_combo_diagrams`",
+                help="Draw combos with mini diagrams rather than on layers",
+                value=draw_cfg.separate_combo_diagrams,
+            )
+        with c2:
+            cfgs["combo_diagrams_scale"] = st.number_input(
+                "`combo_diagrams_scale`",
+                help="Scale factor for mini combo diagrams if `separate_combo_diagrams` is set",
+                value=draw_cfg.combo_diagrams_scale,
+            )
+        cfgs["svg_extra_style"] = st.text_area(
+            "`svg_extra_style`",
+            help="Extra CSS that will be appended to the default `svg_style`",
+            value=draw_cfg.svg_extra_style,
+        )
+        if "footer_text" in draw_fields:
+            cfgs["footer_text"] = st.text_input(
+                "`footer_text`",
+                help="Footer text that will be inserted at the bottom of the drawing",
+                value=draw_cfg.footer_text,
+            )
+
+        common_config_button = st.form_submit_button("Update config")
+        if common_config_button:
+            state.kd_config = dump_config(cfg.model_copy(update={"draw_config": draw_cfg.model_copy(update=cfgs)}))
+            state.kd_config_obj, state.kd_config_log = parse_config(state.kd_config)
+            state.kd_config_hash = get_config_digest(state.kd_config)
+            st.rerun(scope="app")  # propagate config updates to the rest of the app
+
+
+def configuration_row():
     """Show configuration row with common and raw configuration columns."""
     with st.expander("Configuration", expanded=True, icon=":material/manufacturing:"):
         common_col, raw_col = st.columns(2, gap="medium")
         with common_col:
-            st.subheader("Common configuration options", anchor=False)
-            try:
-                cfg = state.kd_config_obj
-            except Exception:
-                cfg = parse_config(get_default_config())
-            draw_cfg = cfg.draw_config
-            cfgs: dict[str, Any] = {}
-            with st.form("common_config"):
-                c1, c2 = st.columns(2)
-                with c1:
-                    cfgs["key_w"] = st.number_input(
-                        "`key_w`",
-                        help="Key width, only used for ortho layouts (not QMK)",
-                        min_value=1,
-                        max_value=999,
-                        step=1,
-                        value=int(draw_cfg.key_w),
-                    )
-                with c2:
-                    cfgs["key_h"] = st.number_input(
-                        "`key_h`",
-                        help="Key height, used for width as well for QMK layouts",
-                        min_value=1,
-                        max_value=999,
-                        step=1,
-                        value=int(draw_cfg.key_h),
-                    )
-                c1, c2 = st.columns(2)
-                with c1:
-                    cfgs["combo_w"] = st.number_input(
-                        "`combo_w`",
-                        help="Combo box width",
-                        min_value=1,
-                        max_value=999,
-                        step=1,
-                        value=int(draw_cfg.combo_w),
-                    )
-                with c2:
-                    cfgs["combo_h"] = st.number_input(
-                        "`combo_h`",
-                        help="Combo box height",
-                        min_value=1,
-                        max_value=999,
-                        step=1,
-                        value=int(draw_cfg.combo_h),
-                    )
-                cfgs["n_columns"] = st.number_input(
-                    "`n_columns`",
-                    help="Number of layer columns in the output drawing",
-                    min_value=1,
-                    max_value=99,
-                    value=draw_cfg.n_columns,
-                )
-                c1, c2 = st.columns(2, vertical_alignment="bottom")
-                cfgs["draw_key_sides"] = c1.toggle(
-                    "`draw_key_sides`", help="Draw key sides, like keycaps", value=draw_cfg.draw_key_sides
-                )
-                if "dark_mode" in draw_cfg.model_fields:
-                    dark_mode_options = {"Auto": "auto", "Off": False, "On": True}
-                    cfgs["dark_mode"] = dark_mode_options[
-                        c2.radio(
-                            "`dark_mode`",
-                            options=list(dark_mode_options),
-                            help='Turn on dark mode, "auto" adapts it to the web page or OS light/dark setting',
-                            horizontal=True,
-                            index=list(dark_mode_options.values()).index(draw_cfg.dark_mode),
-                        )  # type: ignore
-                    ]
-                c1, c2 = st.columns(2, vertical_alignment="bottom")
-                with c1:
-                    cfgs["separate_combo_diagrams"] = st.toggle(
-                        "`separate_combo_diagrams`",
-                        help="Draw combos with mini diagrams rather than on layers",
-                        value=draw_cfg.separate_combo_diagrams,
-                    )
-                with c2:
-                    cfgs["combo_diagrams_scale"] = st.number_input(
-                        "`combo_diagrams_scale`",
-                        help="Scale factor for mini combo diagrams if `separate_combo_diagrams` is set",
-                        value=draw_cfg.combo_diagrams_scale,
-                    )
-                cfgs["svg_extra_style"] = st.text_area(
-                    "`svg_extra_style`",
-                    help="Extra CSS that will be appended to the default `svg_style`",
-                    value=draw_cfg.svg_extra_style,
-                )
-                if "footer_text" in draw_cfg.model_fields:
-                    cfgs["footer_text"] = st.text_input(
-                        "`footer_text`",
-                        help="Footer text that will be inserted at the bottom of the drawing",
-                        value=draw_cfg.footer_text,
-                    )
-
-                common_config_button = st.form_submit_button("Update config")
-                if common_config_button:
-                    cfg.draw_config = draw_cfg.copy(update=cfgs)
-                    state.kd_config = dump_config(cfg)
-                    need_rerun = True
+            common_config_form()
 
         with raw_col:
             c1, c2 = st.columns([0.75, 0.25], gap="medium")
             c1.subheader("Raw configuration", anchor=False)
             c2.link_button(
                 label="Config params :material/open_in_new:",
-                url=f"https://github.com/caksoylar/keymap-drawer/blob/{REPO_REF}/CONFIGURATION.md",
+                url=f"https://github.com/caksoylar/keymap-drawer/blob/{get_repo_ref()}/CONFIGURATION.md",
                 use_container_width=True,
             )
             st.text_area(label="Raw config", key="kd_config", height=655, label_visibility="collapsed")
             st.download_button(label="Download config", data=state.kd_config, file_name="my_config.yaml")
 
-        state.kd_config_obj, config_log = parse_config(state.kd_config)
-        if config_log:
-            st.warning(config_log)
-
-    return need_rerun
+        # only parse raw config if it changed since its last parse, e.g. by the common config form on submit
+        if (config_hash := get_config_digest(state.kd_config)) != state.kd_config_hash:
+            state.kd_config_obj, state.kd_config_log = parse_config(state.kd_config)
+            state.kd_config_hash = config_hash
+        if state.kd_config_log:
+            st.warning(state.kd_config_log)
 
 
 def main():
     """Lay out Streamlit elements and widgets, run parsing and drawing logic."""
-    need_rerun = False
-
-    examples = setup_page()
-    examples_parse_row(examples)
-    need_rerun = keymap_draw_row(need_rerun)
-    need_rerun = configuration_row(need_rerun)
-
-    state.user_query = False
-    if need_rerun:  # rerun if keymap editor needs to be explicitly refreshed or config updates need to be propagated
-        st.rerun()
+    examples, example_keys, initial_query = setup_page()
+    examples_parse_row(examples, example_keys, initial_query)
+    keymap_draw_row()
+    configuration_row()
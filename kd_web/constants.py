@@ -1,9 +1,6 @@
 """Constants used for the web app."""
 
-from importlib.metadata import version
-
 APP_URL = "https://caksoylar.github.io/keymap-drawer"
-REPO_REF = f"v{version('keymap_drawer')}"
 
 DRAW_TIMEOUT = 10
 PARSE_TIMEOUT = 30
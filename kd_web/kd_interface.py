@@ -1,9 +1,13 @@
 """Helper module containing functions that interface with keymap-drawer."""
 
+import hashlib
 import io
 import json
+import threading
+from functools import lru_cache
 from logging import Formatter, StreamHandler
 from pathlib import Path
+from typing import Any, Callable
 
 import timeout_decorator  # type: ignore
 import yaml
@@ -14,21 +18,87 @@ from keymap_drawer.draw import KeymapDrawer
 from keymap_drawer.parse import QmkJsonParser, ZmkKeymapParser
 
 import streamlit as st
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 from .constants import DRAW_TIMEOUT, PARSE_TIMEOUT, LAYOUT_PREAMBLE
 
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+class ThreadLocalStreamHandler(StreamHandler):
+    """
+    Stream handler writing to a reusable in-memory buffer per thread, so that logs from concurrent sessions don't end
+    up in each other's output.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        super().__init__()
+
+    @property  # type: ignore[override]
+    def stream(self) -> io.StringIO:
+        """Log buffer of the current thread, created on first use."""
+        if (buf := getattr(self._local, "buf", None)) is None:
+            buf = self._local.buf = io.StringIO()
+        return buf
+
+    @stream.setter
+    def stream(self, _):
+        """Ignore streams set by the base class, buffers are managed per thread."""
+
+    def capture(self) -> io.StringIO:
+        """Clear and return the log buffer of the current thread, to collect logs from the next operation."""
+        buf = self.stream
+        buf.seek(0)
+        buf.truncate()
+        return buf
+
+
 logger.handlers.clear()
 logger.propagate = False
-log_handler = StreamHandler()
+log_handler = ThreadLocalStreamHandler()
 log_handler.setFormatter(Formatter(fmt="{name}: [{levelname}] {message}", style="{"))
 logger.addHandler(log_handler)
 
 
-@timeout_decorator.timeout(DRAW_TIMEOUT, use_signals=False)
+def _decode_buffer(keymap_buf: io.BytesIO) -> io.StringIO:
+    """Decode an uploaded file in one go rather than through an incremental decoder, keeping its name for parsers."""
+    text_buf = io.StringIO(keymap_buf.getvalue().decode("utf-8"))
+    text_buf.name = getattr(keymap_buf, "name", None)  # type: ignore[attr-defined]
+    return text_buf
+
+
+def _hash_file_buffer(file_buf: io.BytesIO) -> tuple[str | None, str]:
+    """Hash a (possibly uploaded) file buffer for caching on its name, which parsers can use, and contents."""
+    return getattr(file_buf, "name", None), hashlib.sha256(file_buf.getvalue()).hexdigest()
+
+
+CACHE_HASH_FUNCS: dict[str | type[Any], Callable[[Any], Any]] = {
+    ParseConfig: lambda cfg: cfg.model_dump_json(),
+    io.BytesIO: _hash_file_buffer,
+    UploadedFile: _hash_file_buffer,
+}
+
+
+def _dump_keymap_yaml(parsed: dict, preamble: str = "") -> str:
+    """
+    Dump a parsed keymap to YAML in the style shown in the editor, letting the emitter write into a buffer after the
+    optional `preamble`.
+    """
+    with io.StringIO() as out:
+        out.write(preamble)
+        yaml.dump(
+            parsed, out, Dumper=SafeDumper, width=160, sort_keys=False, default_flow_style=None, allow_unicode=True
+        )
+        return out.getvalue()
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
 def read_keymap_yaml(yaml_str: str) -> dict:
-    """Read yaml into dict and assert certain elements are in it."""
+    """Read yaml into dict and assert certain elements are in it, caching the result on the yaml string."""
     assert yaml_str, "Keymap YAML is empty, nothing to draw"
-    yaml_data = yaml.safe_load(yaml_str)
+    yaml_data = yaml.load(yaml_str, Loader=SafeLoader)
     assert "layers" in yaml_data, 'Keymap needs to be specified via the "layers" field in keymap YAML'
     return yaml_data
 
@@ -38,10 +108,10 @@ def draw(keymap_data: dict, config: Config, layout_override: dict | None = None,
     """Given a YAML keymap string, draw the keymap in SVG format to a string."""
 
     if custom_config := keymap_data.get("draw_config"):
-        config.draw_config = config.draw_config.model_copy(update=custom_config)
+        config = config.model_copy(update={"draw_config": config.draw_config.model_copy(update=custom_config)})
 
-    with io.StringIO() as out, io.StringIO() as log_out:
-        log_handler.setStream(log_out)
+    log_out = log_handler.capture()
+    with io.StringIO() as out:
         drawer = KeymapDrawer(
             config=config,
             out=out,
@@ -50,31 +120,41 @@ def draw(keymap_data: dict, config: Config, layout_override: dict | None = None,
             combos=keymap_data.get("combos", []),
         )
         drawer.print_board(**draw_args)
-        log_handler.flush()
         return out.getvalue(), log_out.getvalue()
 
 
-@st.cache_data(max_entries=16)
+@lru_cache(maxsize=16)
 def parse_config(config: str) -> tuple[Config, str]:
-    """Parse config from YAML format."""
-    with io.StringIO() as log_out:
-        log_handler.setStream(log_out)
-        cfg = Config.parse_obj(yaml.safe_load(config))
-        log_handler.flush()
-        return cfg, log_out.getvalue()
+    """Parse config from YAML format. Results are shared between callers, so the returned config must not be mutated."""
+    log_out = log_handler.capture()
+    cfg = Config.parse_obj(yaml.load(config, Loader=SafeLoader))
+    return cfg, log_out.getvalue()
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def draw_keymap(
+    keymap_yaml: str,
+    _config: Config,
+    config_digest: bytes,  # pylint: disable=unused-argument
+    layout_override: dict[str, bytes] | None = None,
+    **draw_args,
+) -> tuple[str, str]:
+    """
+    Draw the keymap from keymap YAML and an already validated config, caching the SVG and log output on the inputs.
+    The config object is not hashed, `config_digest` of its YAML source identifies it for caching instead.
+    `layout_override` maps a layout field to the contents of the layout file, which are hashed cheaply as bytes.
+    """
+    layout = {field: io.BytesIO(data) for field, data in layout_override.items()} if layout_override else None
+    return draw(read_keymap_yaml(keymap_yaml), _config, layout, **draw_args)
 
 
+@st.cache_data(max_entries=8, show_spinner=False, hash_funcs=CACHE_HASH_FUNCS)
 @timeout_decorator.timeout(PARSE_TIMEOUT, use_signals=False)
 def parse_qmk_to_yaml(qmk_keymap_buf: io.BytesIO, config: ParseConfig, num_cols: int) -> tuple[str, str]:
-    """Parse a given QMK keymap JSON (buffer) into keymap YAML."""
-    with io.StringIO() as log_out:
-        log_handler.setStream(log_out)
-        parsed = QmkJsonParser(config, num_cols).parse(io.TextIOWrapper(qmk_keymap_buf, encoding="utf-8"))
-        log_handler.flush()
-        return (
-            yaml.safe_dump(parsed, width=160, sort_keys=False, default_flow_style=None, allow_unicode=True),
-            log_out.getvalue(),
-        )
+    """Parse a given QMK keymap JSON (buffer) into keymap YAML, caching the result on the file contents."""
+    log_out = log_handler.capture()
+    parsed = QmkJsonParser(config, num_cols).parse(_decode_buffer(qmk_keymap_buf))  # type: ignore[arg-type]
+    return _dump_keymap_yaml(parsed), log_out.getvalue()
 
 
 @timeout_decorator.timeout(PARSE_TIMEOUT, use_signals=False)
@@ -83,19 +163,26 @@ def parse_zmk_to_yaml(
 ) -> tuple[str, str]:
     """Parse a given ZMK keymap file (file path or buffer) into keymap YAML."""
     with (
-        open(zmk_keymap, encoding="utf-8")
-        if isinstance(zmk_keymap, Path)
-        else io.TextIOWrapper(zmk_keymap, encoding="utf-8")
-    ) as keymap_buf, io.StringIO() as log_out:
-        log_handler.setStream(log_out)
-        parsed = ZmkKeymapParser(config, num_cols).parse(keymap_buf)
-        log_handler.flush()
+        open(zmk_keymap, encoding="utf-8") if isinstance(zmk_keymap, Path) else _decode_buffer(zmk_keymap)
+    ) as keymap_buf:
+        log_out = log_handler.capture()
+        parsed = ZmkKeymapParser(config, num_cols).parse(keymap_buf)  # type: ignore[arg-type]
         log = log_out.getvalue()
 
     if layout:  # assign or override layout field if provided in app
         parsed["layout"] = json.loads(layout)  # pylint: disable=unsupported-assignment-operation
 
-    out = yaml.safe_dump(parsed, width=160, sort_keys=False, default_flow_style=None, allow_unicode=True)
-    if "layout" not in parsed:  # pylint: disable=unsupported-membership-test
-        return LAYOUT_PREAMBLE + out, log
-    return out, log
+    # prompt to fill in the layout if it couldn't be determined
+    preamble = LAYOUT_PREAMBLE if "layout" not in parsed else ""  # pylint: disable=unsupported-membership-test
+    return _dump_keymap_yaml(parsed, preamble), log
+
+
+@st.cache_data(max_entries=8, show_spinner=False, hash_funcs=CACHE_HASH_FUNCS)
+def parse_zmk_upload_to_yaml(
+    zmk_keymap_buf: io.BytesIO, config: ParseConfig, num_cols: int, layout: str
+) -> tuple[str, str]:
+    """
+    Parse an uploaded ZMK keymap file into keymap YAML, caching the result on the file contents. Keymaps extracted
+    from repos are parsed via `parse_zmk_to_yaml` directly, since their temporary paths would never hit the cache.
+    """
+    return parse_zmk_to_yaml(zmk_keymap_buf, config, num_cols, layout)
@@ -1,129 +1,206 @@
 """Helper module containing utils for streamlit app."""
 
 import base64
-import fnmatch
 import gzip
+import hashlib
 import io
 import json
 import re
+import shutil
 import tempfile
 import zipfile
+import zlib
+from importlib.metadata import version
 from pathlib import Path, PurePosixPath
+from types import MappingProxyType
+from typing import Mapping
 from urllib.error import HTTPError
-from urllib.parse import quote_from_bytes, unquote_to_bytes, urlsplit
-from urllib.request import urlopen
+from urllib.parse import unquote, urlsplit
+from urllib.request import Request, urlopen
 
 import yaml
-from cairosvg import svg2png  # type: ignore
 from lxml import etree  # type: ignore
 from keymap_drawer.config import Config, ParseConfig
 
 import streamlit as st
 
-from .kd_interface import parse_zmk_to_yaml
-from .constants import APP_URL, REPO_REF
+from .kd_interface import CACHE_HASH_FUNCS, SafeDumper, SafeLoader, parse_zmk_to_yaml
+from .constants import APP_URL
+
+RESOURCES_DIR = Path(__file__).parent.parent / "resources"
+EXAMPLE_YAML_RE = re.compile(r"[^/]+/examples/[^/]+\.yaml")  # examples folder under the zipball's root folder
+GZIP_MAGIC = b"\x1f\x8b"
+LOCAL_INCLUDE_RE = re.compile(rb'^\s*#\s*include\s+"', flags=re.MULTILINE)
+SVG_TEXT_REWRITES = {
+    # remove outline from layer headers and footer, they cause rendering issues
+    "</style>": "text.label, text.footer { stroke: none; }</style>",
+    # force text font to DejaVu Sans Mono, since cairosvg does not properly use font-family attribute
+    "font-family: ": "font-family: DejaVu Sans Mono,",
+}
+SVG_TEXT_REWRITE_RE = re.compile("|".join(re.escape(old) for old in SVG_TEXT_REWRITES))
+RELATIVE_FONT_SIZE_XPATH = etree.XPath(
+    r"//*[re:match(@style, 'font-size: \d+(?:\.\d+)?%')]", namespaces={"re": "http://exslt.org/regular-expressions"}
+)
+RELATIVE_FONT_SIZE_RE = re.compile(rb"font-size: \d+(?:\.\d+)?%")
+TOP_LEVEL_TEXT_XPATH = etree.XPath('/*[name()="svg"]/*[name()="text"]')
+ZMK_REF_ETAGS: dict[tuple[str, str, str], tuple[str, str]] = {}  # (owner, repo, head) -> (etag, sha) of last lookup
+ZMK_REF_ETAGS_MAX = 1024
 
 
-@st.cache_data
+@st.cache_resource(show_spinner=False)
+def get_repo_ref() -> str:
+    """Return the keymap-drawer release tag for the installed version."""
+    return f"v{version('keymap_drawer')}"
+
+
+@st.cache_resource(show_spinner=False)
 def get_about() -> str:
     """Read about text and return it as a string."""
-    with open(Path(__file__).parent.parent / "resources" / "about.md", "r", encoding="utf-8") as f:
-        return f.read()
+    return (RESOURCES_DIR / "about.md").read_text(encoding="utf-8")
 
 
-@st.cache_data(max_entries=16)
-def svg_to_png(svg_string: str, background_color: str) -> bytes:
+@st.cache_data(max_entries=4, show_spinner=False)
+def _preprocess_svg(svg_string: str) -> bytes:
     """
-    Convert SVG string in SVG/XML format to PNG using cairosvg, removing the unsupported stroke style for layer headers.
+    Adapt SVG string for cairosvg, removing the unsupported stroke style for layer headers. Cached separately from
+    the conversion so that changing the background color only re-renders the PNG.
     """
-    # remove outline from layer headers and footer, they cause rendering issues
-    input_svg = re.sub("</style>", "text.label, text.footer { stroke: none; }</style>", svg_string)
-
-    # force text font to DejaVu Sans Mono, since cairosvg does not properly use font-family attribute
-    input_svg = input_svg.replace("font-family: ", "font-family: DejaVu Sans Mono,")
+    # apply all text rewrites in a single pass over the SVG, then hand lxml UTF-8 bytes which it parses natively
+    input_svg = SVG_TEXT_REWRITE_RE.sub(lambda m: SVG_TEXT_REWRITES[m.group()], svg_string).encode("utf-8")
 
-    root = etree.XML(input_svg)
+    root = etree.fromstring(input_svg)
 
-    # remove relative font size specifiers since cairosvg can't handle them
-    for node in root.xpath(  # type: ignore
-        r"//*[re:match(@style, 'font-size: \d+(\.\d+)?%')]", namespaces={"re": "http://exslt.org/regular-expressions"}
-    ):
-        del node.attrib["style"]  # type: ignore
+    # remove relative font size specifiers since cairosvg can't handle them, skipping the tree walk if there are none
+    if RELATIVE_FONT_SIZE_RE.search(input_svg):
+        for node in RELATIVE_FONT_SIZE_XPATH(root):
+            del node.attrib["style"]  # type: ignore
 
     # remove links, e.g. from the footer text
-    if text_nodes := root.xpath('/*[name()="svg"]/*[name()="text"]'):
+    if b"<a " in input_svg and (text_nodes := TOP_LEVEL_TEXT_XPATH(root)):
         etree.strip_tags(text_nodes[-1], "{http://www.w3.org/2000/svg}a")  # type: ignore
 
-    return svg2png(bytestring=etree.tostring(root, encoding="utf-8"), background_color=background_color)
+    return etree.tostring(root, encoding="utf-8")
 
 
-@st.cache_data
-def get_example_yamls() -> dict[str, str]:
-    """Return mapping of example keymap YAML names to contents."""
-    repo_zip = _download_zip("caksoylar", "keymap-drawer", REPO_REF)
+@st.cache_data(max_entries=4, show_spinner="Rendering PNG...")
+def svg_to_png(svg_string: str, background_color: str) -> bytes:
+    """Convert SVG string in SVG/XML format to PNG using cairosvg."""
+    # deferred since cairosvg loads the cairo stack, which is only needed for PNG exports
+    from cairosvg import svg2png  # type: ignore  # pylint: disable=import-outside-toplevel
+
+    return svg2png(bytestring=_preprocess_svg(svg_string), background_color=background_color)
+
+
+@st.cache_resource(show_spinner=False)
+def get_example_yamls() -> Mapping[str, str]:
+    """Return read-only mapping of example keymap YAML names to contents, shared across sessions."""
+    repo_zip = _download_zip("caksoylar", "keymap-drawer", get_repo_ref())
     with zipfile.ZipFile(io.BytesIO(repo_zip)) as zipped:
-        files = zipped.namelist()
-        example_paths = sorted([Path(path) for path in files if fnmatch.fnmatch(path, "*/examples/*.yaml")])
-        if not example_paths:
-            raise RuntimeError("Retrying examples failed, please refresh the page :(")
-        return {path.name: zipped.read(path.as_posix()).decode("utf-8") for path in example_paths}
+        examples = sorted(
+            (PurePosixPath(info.filename).name, zipped.read(info).decode("utf-8"))
+            for info in zipped.infolist()
+            if EXAMPLE_YAML_RE.fullmatch(info.filename)
+        )
+    if not examples:
+        raise RuntimeError("Retrying examples failed, please refresh the page :(")
+    return MappingProxyType(dict(examples))
+
+
+class ConfigDumper(SafeDumper):  # pylint: disable=too-many-ancestors
+    """YAML dumper for configs, registering representers here keeps them from leaking into other dumps."""
+
+
+def _cfg_str_representer(dumper, in_str):
+    if "\n" in in_str:  # use '|' style for multiline strings
+        return dumper.represent_scalar("tag:yaml.org,2002:str", in_str, style="|")
+    return dumper.represent_scalar("tag:yaml.org,2002:str", in_str)
+
+
+ConfigDumper.add_representer(str, _cfg_str_representer)
 
 
 def dump_config(cfg: Config) -> str:
     """Convert config to yaml representation."""
+    return yaml.dump(cfg.model_dump(), Dumper=ConfigDumper, sort_keys=False, allow_unicode=True)
 
-    def cfg_str_representer(dumper, in_str):
-        if "\n" in in_str:  # use '|' style for multiline strings
-            return dumper.represent_scalar("tag:yaml.org,2002:str", in_str, style="|")
-        return dumper.represent_scalar("tag:yaml.org,2002:str", in_str)
 
-    yaml.representer.SafeRepresenter.add_representer(str, cfg_str_representer)
-    return yaml.safe_dump(cfg.dict(), sort_keys=False, allow_unicode=True)
+def get_config_digest(config: str) -> bytes:
+    """Return a short digest of config YAML, to detect changes without keeping a copy of the text around."""
+    return hashlib.blake2b(config.encode("utf-8"), digest_size=16).digest()
 
 
-@st.cache_data
+@st.cache_data(show_spinner=False)
 def get_default_config() -> str:
     """Get and dump default config."""
-    with open(Path(__file__).parent.parent / "resources" / "default_config.yaml", encoding="utf-8") as f:
-        config_dict = yaml.safe_load(f)
+    config_dict = yaml.load((RESOURCES_DIR / "default_config.yaml").read_text(encoding="utf-8"), Loader=SafeLoader)
 
     return dump_config(Config(**config_dict))
 
 
+@st.cache_data(ttl=60, max_entries=256, show_spinner=False)
 def _get_zmk_ref(owner: str, repo: str, head: str) -> str:
+    key = (owner, repo, head)
+    last = ZMK_REF_ETAGS.get(key)
+    ref_url = f"https://api.github.com/repos/{owner}/{repo}/git/ref/heads/{head}"
     try:
-        with urlopen(f"https://api.github.com/repos/{owner}/{repo}/git/ref/heads/{head}") as resp:
+        # revalidate the last lookup, unchanged refs get an empty 304 that doesn't count against the rate limit
+        with urlopen(Request(ref_url, headers={"If-None-Match": last[0]} if last else {})) as resp:
             sha = json.load(resp)["object"]["sha"]
-    except HTTPError:
+            if etag := resp.headers.get("ETag"):
+                if len(ZMK_REF_ETAGS) >= ZMK_REF_ETAGS_MAX:
+                    ZMK_REF_ETAGS.clear()
+                ZMK_REF_ETAGS[key] = (etag, sha)
+    except HTTPError as err:
+        if err.code == 304 and last:
+            return last[1]
         # assume we are provided with a reference directly, like a commit SHA
         sha = head
     return sha
 
 
-@st.cache_data(ttl=1800, max_entries=64)
+@st.cache_resource(ttl=1800, max_entries=64)  # zipballs are immutable bytes, so share them without copies
 def _download_zip(owner: str, repo: str, sha: str) -> bytes:
     """Use `sha` only used for caching purposes to make sure we are fetching from the same repo state."""
     zip_url = f"https://api.github.com/repos/{owner}/{repo}/zipball/{sha}"
-    with urlopen(zip_url) as f:
-        return f.read()
+    with urlopen(Request(zip_url, headers={"Accept-Encoding": "gzip"})) as resp, io.BytesIO() as out:
+        shutil.copyfileobj(
+            gzip.GzipFile(fileobj=resp) if resp.headers.get("Content-Encoding") == "gzip" else resp, out, 1 << 20
+        )
+        return out.getvalue()
 
 
 def _extract_zip_and_parse(
     zip_bytes: bytes, keymap_path: PurePosixPath, config: ParseConfig, num_cols: int, layout: str
-) -> str:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zipped:
+) -> tuple[str, str]:
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zipped:
+        root = zipped.namelist()[0].split("/", 1)[0]  # top-level folder that Github creates in zipballs
+        try:
+            keymap_bytes = zipped.read(f"{root}/{keymap_path}")
+        except KeyError as err:
+            raise ValueError(f"Could not find '{keymap_path}' in the repo, please check URL") from err
+
+        if not LOCAL_INCLUDE_RE.search(keymap_bytes):  # parse from memory if keymap doesn't need other repo files
+            keymap_buf = io.BytesIO(keymap_bytes)
+            keymap_buf.name = keymap_path.name  # type: ignore[attr-defined]
+            return parse_zmk_to_yaml(keymap_buf, config, num_cols, layout)
+
+        # local includes are resolved relative to the keymap path, so extract the repo to disk for them
+        with tempfile.TemporaryDirectory() as tmpdir:
             zipped.extractall(tmpdir)
-        keymap_file = next(path for path in Path(tmpdir).iterdir() if path.is_dir()) / keymap_path
-        if not keymap_file.exists():
-            raise ValueError(f"Could not find '{keymap_path}' in the repo, please check URL")
-        return parse_zmk_to_yaml(keymap_file, config, num_cols, layout)
+            return parse_zmk_to_yaml(Path(tmpdir) / root / keymap_path, config, num_cols, layout)
 
 
-def parse_zmk_url_to_yaml(zmk_url: str, config: ParseConfig, num_cols: int, layout: str) -> str:
+@st.cache_data(
+    ttl=600,
+    max_entries=64,
+    show_spinner="Fetching repo...",
+    hash_funcs=CACHE_HASH_FUNCS,
+)
+def parse_zmk_url_to_yaml(zmk_url: str, config: ParseConfig, num_cols: int, layout: str) -> tuple[str, str]:
     """
     Parse a given ZMK keymap URL on Github into keymap YAML. Normalize URL, extract owner/repo/head name,
-    get reference (not cached), download contents from reference (cached) and parse keymap (cached).
+    get reference, download contents from reference (cached) and parse keymap. Results are cached on the URL and
+    parse arguments for 10 minutes, so branch updates are picked up after that or after `refresh_zmk_url`.
     """
     if not zmk_url.startswith("https") and not zmk_url.startswith("//"):
         zmk_url = "//" + zmk_url
@@ -141,15 +218,28 @@ def parse_zmk_url_to_yaml(zmk_url: str, config: ParseConfig, num_cols: int, layo
     return _extract_zip_and_parse(zip_bytes, keymap_path, config, num_cols, layout)
 
 
+def refresh_zmk_url(zmk_url: str, config: ParseConfig, num_cols: int, layout: str) -> None:
+    """Drop cached results for parsing a ZMK keymap URL, so that the next parse fetches the latest repo state."""
+    parse_zmk_url_to_yaml.clear(zmk_url, config, num_cols, layout)  # type: ignore[attr-defined]
+    # refs are only cached briefly, so dropping those of other repos is cheap
+    _get_zmk_ref.clear()  # type: ignore[attr-defined]
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
 def get_permalink(keymap_yaml: str) -> str:
     """Encode a keymap using a compressed base64 string and place it in query params to create a permalink."""
-    b64_bytes = base64.b64encode(gzip.compress(keymap_yaml.encode("utf-8"), mtime=0), altchars=b"-_")
-    return f"{APP_URL}?keymap_yaml={quote_from_bytes(b64_bytes)}"
+    b64_str = base64.urlsafe_b64encode(zlib.compress(keymap_yaml.encode("utf-8"), 9)).decode("ascii")
+    return f"{APP_URL}?keymap_yaml={b64_str.rstrip('=')}"  # url-safe alphabet, so only padding needs handling
 
 
 def decode_permalink_param(param: str) -> str:
     """Get a compressed base64 string from query params and decode it to keymap YAML."""
-    return gzip.decompress(base64.b64decode(unquote_to_bytes(param), altchars=b"-_")).decode("utf-8")
+    if "%" in param:  # percent-encoded padding from older permalinks
+        param = unquote(param)
+    compressed = base64.urlsafe_b64decode(param + "=" * (-len(param) % 4))
+    if compressed.startswith(GZIP_MAGIC):  # permalinks created before the switch to zlib
+        return gzip.decompress(compressed).decode("utf-8")
+    return zlib.decompress(compressed).decode("utf-8")
 
 
 def handle_exception(container, message: str, exc: Exception):